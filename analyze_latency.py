@@ -6,41 +6,208 @@ This script runs multiple YCSB tests and analyzes the latency patterns
 over time during dynamic load phases.
 """
 
+import math
 import subprocess
 import re
 import os
+import signal
 import sys
+import tempfile
+import threading
 import time
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
+from array import array
 from datetime import datetime
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Prefix of the "[UPDATE], timestamp, latency" time series lines
+_UPDATE_PREFIX = '[UPDATE],'
+# Phase: PhaseName, Throughput: X ops/sec, Elapsed: Xms
+_PHASE_RE = re.compile(
+    r'Phase:\s*(\w+),\s*Throughput:\s*([\d.]+)\s*ops/sec,\s*Elapsed:\s*(\d+)ms',
+    re.ASCII)
+
+# Columns of the per-run phase record array
+_PHASE_DTYPE = np.dtype([('name', 'U32'), ('throughput', 'f8'), ('elapsed', 'i8')])
+
+# Phase boundaries in ms (from workload3 configuration)
+_PHASE_BOUNDARIES = (
+    (0, 10000, "Baseline (1K ops/sec)"),
+    (10000, 20000, "Moderate (5K ops/sec)"),
+    (20000, 30000, "High (20K ops/sec)"),
+    (30000, 40000, "VeryHigh (50K ops/sec)"),
+    (40000, 50000, "Extreme (100K ops/sec)")
+)
+
+# Above this many samples the latency plot is drawn as a density heatmap
+_DENSE_PLOT_POINTS = 5000
+
+
+def _percentile95(a):
+    """95th percentile of a non-empty array via a partial sort"""
+    k = int(0.95 * len(a))
+    return np.partition(a, k)[k]
+
+
+def _import_pyplot(interactive):
+    """Import pyplot on first use, with the Agg backend unless interactive"""
+    import matplotlib
+    if not interactive:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
+def _savefig(plt, save_file, dpi):
+    """Save the current figure, favouring encode speed over size for PNGs"""
+    kwargs = {}
+    if save_file.lower().endswith('.png'):
+        kwargs['pil_kwargs'] = {'compress_level': 1}
+    plt.savefig(save_file, dpi=dpi, bbox_inches='tight', **kwargs)
+
+
+def _kill_process_group(proc):
+    """Kill a process started with start_new_session=True and its children"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+
+def _add_phase_boundaries(ax, color):
+    """Draw every phase boundary as a full-height dashed line in one artist"""
+    from matplotlib.collections import LineCollection
+    
+    xs = sorted({x for start, end, _ in _PHASE_BOUNDARIES for x in (start, end)})
+    # x in data coordinates, y spanning the axes like axvline
+    ax.add_collection(LineCollection([[(x, 0), (x, 1)] for x in xs],
+                                     colors=color, linestyles='--', alpha=0.5,
+                                     transform=ax.get_xaxis_transform()),
+                      autolim=False)
+    # Widen the x-limits to include every boundary, as axvline does
+    ax.update_datalim([(xs[0], 0), (xs[-1], 0)], updatey=False)
+    ax.autoscale_view(scaley=False)
+
+
 class YCSBLatencyAnalyzer:
-    def __init__(self, test_script="./test.sh", num_runs=3):
+    def __init__(self, test_script="./test.sh", num_runs=3, parallel=1, interactive=False):
         self.test_script = test_script
         self.num_runs = num_runs
+        self.parallel = parallel
+        # Show plots in a window; otherwise figures are closed once saved
+        self.interactive = interactive
         self.results = []
+        # All runs' latencies concatenated once, and their 95th percentile
+        self._all_lat = None
+        self._all_lat_p95 = None
+        
+    def _run_and_parse(self, run_id, timeout=300):
+        """Run a single test, parsing its output as it is streamed
         
-    def run_single_test(self, run_id):
-        """Run a single test and capture output"""
+        Returns (timestamps, latencies, phases) or None if the test failed.
+        """
         print(f"Running test {run_id + 1}/{self.num_runs}...")
         
+        timestamps = array('q')
+        latencies = array('d')
+        phases = []
+        
         try:
-            # Run the test script and capture output
-            result = subprocess.run(
-                [self.test_script], 
-                capture_output=True, 
-                text=True, 
-                timeout=300  # 5 minute timeout
-            )
-            
-            if result.returncode != 0:
-                print(f"Test {run_id + 1} failed with return code {result.returncode}")
-                print(f"Error output: {result.stderr}")
-                return None
+            # stderr goes to a temp file so a chatty test cannot fill the
+            # pipe and stall while we are reading stdout
+            with tempfile.TemporaryFile(mode='w+') as stderr:
+                proc = subprocess.Popen(
+                    [self.test_script],
+                    stdout=subprocess.PIPE,
+                    stderr=stderr,
+                    text=True,
+                    bufsize=1,
+                    # Own process group, so a timeout also kills the java
+                    # process started by the script, which holds stdout open
+                    start_new_session=True
+                )
+                # 5 minute timeout, enforced while stdout is still open
+                timed_out = threading.Event()
+                
+                def kill():
+                    timed_out.set()
+                    _kill_process_group(proc)
+                
+                timer = threading.Timer(timeout, kill)
+                timer.start()
+                
+                try:
+                    for line in proc.stdout:
+                        # UPDATE lines have a fixed layout, so split them
+                        # directly and keep the regex for the rare Phase lines;
+                        # other lines are rejected with plain substring checks
+                        if line.startswith(_UPDATE_PREFIX):
+                            parts = line.split(',', 2)
+                            # Timestamps are plain digits; YCSB prints NaN
+                            # latencies for intervals with no operations
+                            if len(parts) < 3 or not parts[1].strip().isdigit():
+                                continue
+                            try:
+                                ts = int(parts[1])
+                                lat = float(parts[2])
+                            except ValueError:
+                                continue
+                            if not math.isfinite(lat):
+                                continue
+                            timestamps.append(ts)
+                            latencies.append(lat)
+                            continue
+                        
+                        if 'Phase:' not in line:
+                            continue
+                        
+                        m = _PHASE_RE.search(line)
+                        if m:
+                            try:
+                                phases.append((m.group(1),
+                                               float(m.group(2)),
+                                               int(m.group(3))))
+                            except ValueError:
+                                continue
+                    
+                    returncode = proc.wait(timeout=timeout)
+                finally:
+                    timer.cancel()
+                    if proc.poll() is None:
+                        _kill_process_group(proc)
+                        proc.wait()
+                    proc.stdout.close()
                 
-            return result.stdout
+                if timed_out.is_set():
+                    print(f"Test {run_id + 1} timed out")
+                    return None
+                
+                if returncode != 0:
+                    stderr.seek(0)
+                    print(f"Test {run_id + 1} failed with return code {returncode}")
+                    print(f"Error output: {stderr.read()}")
+                    return None
+            
+            # Wrap the typed buffers without copying
+            timestamps = np.frombuffer(timestamps, dtype=np.int64)
+            latencies = np.frombuffer(latencies, dtype=np.float64)
+            
+            # YCSB reports samples in time order, so only sort if needed
+            if np.any(timestamps[1:] < timestamps[:-1]):
+                order = np.argsort(timestamps, kind='stable')
+                timestamps = timestamps[order]
+                latencies = latencies[order]
+            
+            # Phases become a record array with typed name/throughput/elapsed columns
+            phases = np.rec.array(np.array(phases, dtype=_PHASE_DTYPE))
+            
+            return timestamps, latencies, phases
             
         except subprocess.TimeoutExpired:
             print(f"Test {run_id + 1} timed out")
@@ -49,191 +216,158 @@ class YCSBLatencyAnalyzer:
             print(f"Error running test {run_id + 1}: {e}")
             return None
     
-    def extract_timeseries_data(self, output):
-        """Extract time series latency data from YCSB output"""
-        timeseries_data = []
-        
-        # Look for UPDATE time series data
-        # Format: [UPDATE], timestamp, latency
-        pattern = r'\[UPDATE\],\s*(\d+),\s*([\d.]+)'
-        
-        matches = re.findall(pattern, output)
-        
-        for timestamp_str, latency_str in matches:
-            try:
-                timestamp = int(timestamp_str)
-                latency = float(latency_str)
-                timeseries_data.append((timestamp, latency))
-            except ValueError:
-                continue
-                
-        return sorted(timeseries_data)
-    
-    def extract_phase_info(self, output):
-        """Extract dynamic load phase information"""
-        phases = []
-        
-        # Look for phase information in status output
-        # Pattern: Phase: PhaseName, Throughput: X ops/sec, Elapsed: Xms
-        phase_pattern = r'Phase:\s*(\w+),\s*Throughput:\s*([\d.]+)\s*ops/sec,\s*Elapsed:\s*(\d+)ms'
-        
-        matches = re.findall(phase_pattern, output)
+    def _collect_result(self, run_id, parsed):
+        """Store the parsed output of a single test"""
+        if parsed is None:
+            return
+            
+        timestamps, latencies, phase_info = parsed
         
-        for phase_name, throughput_str, elapsed_str in matches:
-            try:
-                throughput = float(throughput_str)
-                elapsed = int(elapsed_str)
-                phases.append({
-                    'name': phase_name,
-                    'throughput': throughput,
-                    'elapsed': elapsed
-                })
-            except ValueError:
-                continue
-                
-        return phases
+        if len(timestamps):
+            self.results.append({
+                'run_id': run_id + 1,
+                'ts': timestamps,
+                'lat': latencies,
+                'phases': phase_info,
+                'timestamp': datetime.now().isoformat()
+            })
+            print(f"Test {run_id + 1} completed: {len(timestamps)} data points")
+        else:
+            print(f"Test {run_id + 1} completed but no time series data found")
     
     def run_all_tests(self):
-        """Run all tests and collect data"""
+        """Run all tests and collect data
+        
+        With parallel > 1 the runs are started concurrently and without the
+        cooldown between them, so every run must use its own database or the
+        test script must tolerate being run alongside itself.
+        """
         print(f"Starting {self.num_runs} test runs...")
         
-        for i in range(self.num_runs):
-            output = self.run_single_test(i)
-            
-            if output is None:
-                continue
+        if self.parallel > 1:
+            max_workers = min(self.parallel, self.num_runs, os.cpu_count() or 1)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                futures = {executor.submit(self._run_and_parse, i): i
+                           for i in range(self.num_runs)}
+                for future in as_completed(futures):
+                    self._collect_result(futures[future], future.result())
+            self.results.sort(key=lambda result: result['run_id'])
+        else:
+            for i in range(self.num_runs):
+                self._collect_result(i, self._run_and_parse(i))
                 
-            # Extract data
-            timeseries_data = self.extract_timeseries_data(output)
-            phase_info = self.extract_phase_info(output)
-            
-            if timeseries_data:
-                self.results.append({
-                    'run_id': i + 1,
-                    'timeseries': timeseries_data,
-                    'phases': phase_info,
-                    'timestamp': datetime.now().isoformat()
-                })
-                print(f"Test {i + 1} completed: {len(timeseries_data)} data points")
-            else:
-                print(f"Test {i + 1} completed but no time series data found")
-            
-            # Wait between tests
-            if i < self.num_runs - 1:
-                print("Waiting 10 seconds before next test...")
-                time.sleep(10)
+                # Wait between tests
+                if i < self.num_runs - 1:
+                    print("Waiting 10 seconds before next test...")
+                    time.sleep(10)
+        
+        if self.results:
+            self._all_lat = np.concatenate([result['lat'] for result in self.results])
+            self._all_lat_p95 = _percentile95(self._all_lat)
     
-    def plot_latency_over_time(self, save_file="latency_analysis.png"):
+    def plot_latency_over_time(self, save_file="latency_analysis.png", dpi=150):
         """Plot latency over time for all runs"""
         if not self.results:
             print("No data to plot")
             return
-            
-        plt.figure(figsize=(15, 10))
         
-        # Define phase boundaries (from workload3 configuration)
-        phase_boundaries = [
-            (0, 10000, "Baseline (1K ops/sec)"),
-            (10000, 20000, "Moderate (5K ops/sec)"),
-            (20000, 30000, "High (20K ops/sec)"),
-            (30000, 40000, "VeryHigh (50K ops/sec)"),
-            (40000, 50000, "Extreme (100K ops/sec)")
-        ]
+        plt = _import_pyplot(self.interactive)
+            
+        fig = plt.figure(figsize=(15, 10))
         
-        # Plot each run
-        colors = ['blue', 'red', 'green', 'orange', 'purple']
+        all_timestamps = np.concatenate([result['ts'] for result in self.results])
+        dense = len(all_timestamps) > _DENSE_PLOT_POINTS
         
-        for i, result in enumerate(self.results):
-            timeseries = result['timeseries']
-            if not timeseries:
-                continue
-                
-            timestamps = [t[0] for t in timeseries]
-            latencies = [t[1] for t in timeseries]
+        if dense:
+            # Too many samples to draw individually: show a log-density
+            # heatmap of all runs over the visible latency range instead
+            counts, xedges, yedges = np.histogram2d(
+                all_timestamps, self._all_lat, bins=(2000, 400),
+                range=[[all_timestamps.min(), all_timestamps.max()],
+                       [0, self._all_lat_p95 * 1.1]])
+            plt.imshow(np.log1p(counts.T),
+                       extent=[xedges[0], xedges[-1], yedges[0], yedges[-1]],
+                       origin='lower', aspect='auto', cmap='viridis')
+            plt.colorbar(label=f'log(1 + samples), {len(self.results)} runs')
+        else:
+            # Plot each run
+            colors = ['blue', 'red', 'green', 'orange', 'purple']
             
-            color = colors[i % len(colors)]
-            plt.plot(timestamps, latencies, 
-                    label=f'Run {result["run_id"]}', 
-                    color=color, alpha=0.7, linewidth=1)
+            for i, result in enumerate(self.results):
+                timestamps = result['ts']
+                latencies = result['lat']
+                if not len(timestamps):
+                    continue
+                
+                color = colors[i % len(colors)]
+                plt.plot(timestamps, latencies, 
+                        label=f'Run {result["run_id"]}', 
+                        color=color, alpha=0.7, linewidth=1,
+                        rasterized=True, antialiased=False)
         
         # Add phase boundaries
-        for start, end, label in phase_boundaries:
-            plt.axvline(x=start, color='gray', linestyle='--', alpha=0.5)
-            plt.axvline(x=end, color='gray', linestyle='--', alpha=0.5)
-            
+        _add_phase_boundaries(plt.gca(), 'gray')
+        
+        label_y = plt.ylim()[1] * 0.9
+        for start, end, label in _PHASE_BOUNDARIES:
             # Add phase labels
             mid_point = (start + end) / 2
-            plt.text(mid_point, plt.ylim()[1] * 0.9, label, 
+            plt.text(mid_point, label_y, label, 
                     rotation=90, ha='center', va='top', fontsize=8)
         
         plt.xlabel('Time (ms)')
         plt.ylabel('Latency (μs)')
         plt.title('YCSB Dynamic Load Test - Latency Over Time')
-        plt.legend()
+        if not dense:
+            plt.legend()
         plt.grid(True, alpha=0.3)
         
         # Set reasonable y-axis limits
         if self.results:
-            all_latencies = []
-            for result in self.results:
-                all_latencies.extend([t[1] for t in result['timeseries']])
-            
-            if all_latencies:
-                max_latency = np.percentile(all_latencies, 95)  # Use 95th percentile to avoid outliers
-                plt.ylim(0, max_latency * 1.1)
+            max_latency = self._all_lat_p95  # Use 95th percentile to avoid outliers
+            plt.ylim(0, max_latency * 1.1)
         
         plt.tight_layout()
-        plt.savefig(save_file, dpi=300, bbox_inches='tight')
+        _savefig(plt, save_file, dpi)
         print(f"Plot saved to {save_file}")
-        plt.show()
+        if self.interactive:
+            plt.show()
+        else:
+            plt.close(fig)
     
-    def plot_average_latency(self, save_file="average_latency.png"):
+    def plot_average_latency(self, save_file="average_latency.png", dpi=150):
         """Plot average latency across all runs"""
         if not self.results:
             print("No data to plot")
             return
-            
-        # Collect all data points by timestamp
-        timestamp_latencies = {}
-        
-        for result in self.results:
-            for timestamp, latency in result['timeseries']:
-                if timestamp not in timestamp_latencies:
-                    timestamp_latencies[timestamp] = []
-                timestamp_latencies[timestamp].append(latency)
         
-        # Calculate averages and standard deviations
-        timestamps = sorted(timestamp_latencies.keys())
-        avg_latencies = []
-        std_latencies = []
+        plt = _import_pyplot(self.interactive)
+            
+        # Group all data points by timestamp
+        all_ts = np.concatenate([result['ts'] for result in self.results])
+        all_lat = self._all_lat
+        timestamps, inverse = np.unique(all_ts, return_inverse=True)
         
-        for ts in timestamps:
-            latencies = timestamp_latencies[ts]
-            avg_latencies.append(np.mean(latencies))
-            std_latencies.append(np.std(latencies))
+        # Calculate averages and standard deviations per timestamp
+        counts = np.bincount(inverse)
+        avg_latencies = np.bincount(inverse, weights=all_lat) / counts
+        deviations = all_lat - avg_latencies[inverse]
+        std_latencies = np.sqrt(np.bincount(inverse, weights=deviations ** 2) / counts)
         
-        plt.figure(figsize=(15, 8))
+        fig = plt.figure(figsize=(15, 8))
         
         # Plot average with error bars
         plt.errorbar(timestamps, avg_latencies, yerr=std_latencies, 
                     capsize=2, capthick=1, alpha=0.7)
         
         # Add phase boundaries
-        phase_boundaries = [
-            (0, 10000, "Baseline (1K ops/sec)"),
-            (10000, 20000, "Moderate (5K ops/sec)"),
-            (20000, 30000, "High (20K ops/sec)"),
-            (30000, 40000, "VeryHigh (50K ops/sec)"),
-            (40000, 50000, "Extreme (100K ops/sec)")
-        ]
+        _add_phase_boundaries(plt.gca(), 'red')
         
-        for start, end, label in phase_boundaries:
-            plt.axvline(x=start, color='red', linestyle='--', alpha=0.5)
-            plt.axvline(x=end, color='red', linestyle='--', alpha=0.5)
-            
+        label_y = float(np.max(avg_latencies)) * 0.9
+        for start, end, label in _PHASE_BOUNDARIES:
             # Add phase labels
             mid_point = (start + end) / 2
-            plt.text(mid_point, max(avg_latencies) * 0.9, label, 
+            plt.text(mid_point, label_y, label, 
                     rotation=90, ha='center', va='top', fontsize=8)
         
         plt.xlabel('Time (ms)')
@@ -241,14 +375,30 @@ class YCSBLatencyAnalyzer:
         plt.title(f'YCSB Dynamic Load Test - Average Latency Over Time ({self.num_runs} runs)')
         plt.grid(True, alpha=0.3)
         plt.tight_layout()
-        plt.savefig(save_file, dpi=300, bbox_inches='tight')
+        _savefig(plt, save_file, dpi)
         print(f"Average plot saved to {save_file}")
-        plt.show()
+        if self.interactive:
+            plt.show()
+        else:
+            plt.close(fig)
     
     def save_raw_data(self, save_file="latency_data.json"):
         """Save raw data to JSON file"""
-        with open(save_file, 'w') as f:
-            json.dump(self.results, f, indent=2)
+        # Phase records are written as one object per phase
+        results = [dict(result, phases=[dict(zip(_PHASE_DTYPE.names, phase))
+                                        for phase in result['phases'].tolist()])
+                   for result in self.results]
+        
+        if orjson is not None:
+            # orjson serializes the numpy arrays natively, without a list copy
+            with open(save_file, 'wb') as f:
+                f.write(orjson.dumps(results,
+                                     option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2))
+        else:
+            with open(save_file, 'w') as f:
+                # Arrays are only turned into lists at the JSON boundary
+                json.dump([dict(result, ts=result['ts'].tolist(), lat=result['lat'].tolist())
+                           for result in results], f, indent=2)
         print(f"Raw data saved to {save_file}")
     
     def print_summary(self):
@@ -262,30 +412,26 @@ class YCSBLatencyAnalyzer:
         print("="*50)
         
         for result in self.results:
-            timeseries = result['timeseries']
-            if not timeseries:
+            latencies = result['lat']
+            if not len(latencies):
                 continue
-                
-            latencies = [t[1] for t in timeseries]
             
             print(f"\nRun {result['run_id']}:")
             print(f"  Data points: {len(latencies)}")
-            print(f"  Min latency: {min(latencies):.2f} μs")
-            print(f"  Max latency: {max(latencies):.2f} μs")
-            print(f"  Avg latency: {np.mean(latencies):.2f} μs")
-            print(f"  95th percentile: {np.percentile(latencies, 95):.2f} μs")
+            print(f"  Min latency: {latencies.min():.2f} μs")
+            print(f"  Max latency: {latencies.max():.2f} μs")
+            print(f"  Avg latency: {latencies.mean():.2f} μs")
+            print(f"  95th percentile: {_percentile95(latencies):.2f} μs")
         
         # Overall statistics
-        all_latencies = []
-        for result in self.results:
-            all_latencies.extend([t[1] for t in result['timeseries']])
+        all_latencies = self._all_lat
         
-        if all_latencies:
+        if len(all_latencies):
             print(f"\nOverall Statistics ({len(all_latencies)} total data points):")
-            print(f"  Min latency: {min(all_latencies):.2f} μs")
-            print(f"  Max latency: {max(all_latencies):.2f} μs")
-            print(f"  Avg latency: {np.mean(all_latencies):.2f} μs")
-            print(f"  95th percentile: {np.percentile(all_latencies, 95):.2f} μs")
+            print(f"  Min latency: {all_latencies.min():.2f} μs")
+            print(f"  Max latency: {all_latencies.max():.2f} μs")
+            print(f"  Avg latency: {all_latencies.mean():.2f} μs")
+            print(f"  95th percentile: {self._all_lat_p95:.2f} μs")
 
 
 def main():
@@ -296,6 +442,11 @@ def main():
     parser.add_argument('--runs', type=int, default=4, help='Number of test runs (default: 3)')
     parser.add_argument('--script', default='./test.sh', help='Test script path (default: ./test.sh)')
     parser.add_argument('--no-plot', action='store_true', help='Skip plotting')
+    parser.add_argument('--interactive', action='store_true', help='Show plots after saving them')
+    parser.add_argument('--dpi', type=int, default=150, help='Resolution of saved plots (default: 150)')
+    parser.add_argument('--parallel', type=int, default=1,
+                        help='Number of test runs to execute concurrently (default: 1). '
+                             'Only use when runs do not share state such as the test database')
     
     args = parser.parse_args()
     
@@ -305,10 +456,12 @@ def main():
         sys.exit(1)
     
     # Make sure test script is executable
-    os.chmod(args.script, 0o755)
+    if not os.access(args.script, os.X_OK):
+        os.chmod(args.script, 0o755)
     
     # Create analyzer
-    analyzer = YCSBLatencyAnalyzer(test_script=args.script, num_runs=args.runs)
+    analyzer = YCSBLatencyAnalyzer(test_script=args.script, num_runs=args.runs,
+                                   parallel=args.parallel, interactive=args.interactive)
     
     try:
         # Run tests
@@ -322,8 +475,8 @@ def main():
         
         # Generate plots
         if not args.no_plot:
-            analyzer.plot_latency_over_time()
-            analyzer.plot_average_latency()
+            analyzer.plot_latency_over_time(dpi=args.dpi)
+            analyzer.plot_average_latency(dpi=args.dpi)
         
     except KeyboardInterrupt:
         print("\nAnalysis interrupted by user")
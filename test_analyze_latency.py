@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Tests for analyze_latency.py
+"""
+
+import os
+import stat
+import tempfile
+import time
+import unittest
+
+from analyze_latency import YCSBLatencyAnalyzer
+
+
+class RunAndParseTimeoutTest(unittest.TestCase):
+    def setUp(self):
+        # Stands in for test.sh: the child keeps stdout open after the
+        # script's own process is killed, like the java process from bin/ycsb
+        fd, self.script = tempfile.mkstemp(suffix='.sh')
+        with os.fdopen(fd, 'w') as f:
+            f.write('#!/bin/bash\n'
+                    'echo "[UPDATE], 1, 2.0"\n'
+                    'sleep 30\n')
+        os.chmod(self.script, stat.S_IRWXU)
+
+    def tearDown(self):
+        os.remove(self.script)
+
+    def test_timeout_kills_whole_process_group(self):
+        analyzer = YCSBLatencyAnalyzer(test_script=self.script, num_runs=1)
+
+        start = time.monotonic()
+        parsed = analyzer._run_and_parse(0, timeout=2)
+        elapsed = time.monotonic() - start
+
+        self.assertIsNone(parsed)
+        self.assertLess(elapsed, 10)
+
+
+if __name__ == "__main__":
+    unittest.main()